@@ -13,6 +13,11 @@ import subprocess
 import random
 import requests
 import math
+import re
+import time
+import signal
+import shutil
+import psutil
 from snakemake.utils import read_job_properties
 import functools
 print = functools.partial(print, flush=True)
@@ -20,6 +25,23 @@ print = functools.partial(print, flush=True)
 def str2dt(s):
 	return datetime.datetime.strptime(s, '%Y-%m-%d %H:%M:%S.%f')
 
+# jobs running on the local lane have a 'local:<pid>:<start time>' instance_id
+def is_local(instance_id):
+	return instance_id is not None and instance_id.startswith('local:')
+
+def local_instance_id(pid):
+	return 'local:{}:{}'.format(pid, psutil.Process(pid).create_time())
+
+# the runner process of a local job, None if it is gone or the pid was reused
+def local_runner(instance_id):
+	_, pid, t = instance_id.split(':')
+	try:
+		p = psutil.Process(int(pid))
+		if p.create_time() == float(t): return p
+	except (psutil.NoSuchProcess, psutil.AccessDenied):
+		pass
+	return None
+
 def pp_table(data):
 	ms = list(map(len, data[0]))
 	for r in data:
@@ -87,17 +109,36 @@ class Cache:
 			return False
 	def create_db(self):
 		with self.open() as db:
-			n, = db.execute('select count(*) from sqlite_master where type=? and name=?',('table','jobs')).fetchone()
+			n, = db.execute('select count(*) from sqlite_master where type=? and name=?',('table','runtimes')).fetchone()
 			if n>0: return
 			db.execute('create table if not exists jobs (jobid, jobname, status, instance_id, orig_jobscript, start_time, end_time, PRIMARY KEY(jobid))')
 			db.execute('create table if not exists spot_prices (it, az, price, backoff, PRIMARY KEY(it,az))')
-			db.execute('create table if not exists instance_types (it, cpus, mem_mb, storage_gb, PRIMARY KEY(it))')
-			db.execute('create table if not exists it_features (it, key, value, PRIMARY KEY(it,key))')
+			self.create_catalog(db)
 			db.execute('create table if not exists timed_locks (key, dt, PRIMARY KEY(key))')
 			db.execute('create table if not exists meta (key,value, PRIMARY KEY(key))')
+			db.execute('create table if not exists runtimes (rule, it, runtime)')
+	def create_catalog(self, db):
+		db.execute('create table if not exists instance_types (it, cpus, mem_mb, storage_gb, arch, network_gbps, ebs_mbps, nvme_disks, clock_ghz, perf, PRIMARY KEY(it))')
+		db.execute('create table if not exists it_features (it, key, value, PRIMARY KEY(it,key))')
 
 class HD:
 	job_end_states = ['SUCCESS','FAILED']
+	# bump when the instance_types schema or contents change
+	catalog_version = 3
+	# sustained clock of the perf=1.0 reference (m5), for families without a score
+	perf_ref_ghz = 3.1
+	# runtimes used to predict the next one
+	runtime_history = 20
+	# ec2 limit for UserData
+	userdata_max_bytes = 16*1024
+	# gp3 limits per volume, baseline iops/throughput are included in the price
+	gp3_base_iops = 3000
+	gp3_base_mbps = 125
+	gp3_max_iops = 16000
+	gp3_max_mbps = 1000
+	gp3_max_iops_per_gb = 500
+	gp3_max_volumes = 8
+	gp3_max_gb = 16384
 
 	def msg(self, s, end='\n', head=True):
 		h = self.pname+': ' if head else ''
@@ -113,7 +154,9 @@ class HD:
 		subparser.add_parser('submit-job').add_argument('jobscript')
 		subparser.add_parser('status',help='list jobs')
 		subparser.add_parser('clean-cache', help='clean finished jobs')
+		subparser.add_parser('refresh-catalog', help='refresh instance-type data')
 		subparser.add_parser('kill', help='kill a job').add_argument('jobid')
+		subparser.add_parser('run-local', help='run a job on the local lane').add_argument('jobid')
 		p2 = subparser.add_parser('log', help='print logs from a job')
 		p2.add_argument('-n', '--lines', default=10, type=int, required=False)
 		p2.add_argument('--head', action='store_true')
@@ -122,6 +165,7 @@ class HD:
 		p3.add_argument('--stack-name', required=True)
 		p3.add_argument('--prefix', required=True)
 		p3.add_argument('--ami', required=True)
+		p3.add_argument('--ami-arm64', help='AMI used for arm64 instances')
 		p3.add_argument('--cache', default='hyperdrive.cache')
 		self.args, self.extra_args = self.parser.parse_known_args()
 		self.conf = {}
@@ -132,28 +176,59 @@ class HD:
 			self.msg('run "{} config" first'.format(self.pname))
 			sys.exit(1)
 
-	def get_ebs_gp2_price(self):
+	def get_ebs_prices(self):
+		keys = ['ebs_gp3_gb_price','ebs_gp3_iops_price','ebs_gp3_mbps_price']
 		with self.cache.open() as db:
-			r = db.execute('select value from meta where key=?',('ebs_gp2_price',)).fetchone()
-			if r is not None:
-				return r[0]
+			r = db.execute('select key,value from meta where key in (?,?,?)',keys).fetchall()
+			if len(r) == len(keys):
+				return dict(map(tuple, r))
 
 		region_name = boto3.client('ec2').meta.region_name
 		url = 'https://pricing.us-east-1.amazonaws.com/offers/v1.0/aws/AmazonEC2/current/{}/index.json'
 		data = requests.get(url.format(region_name)).json()
-		def gp2(k):
+		def gp3(k, family):
+			if data['products'][k].get('productFamily') != family: return False
 			if 'attributes' not in data['products'][k]: return False
 			if 'volumeApiName' not in data['products'][k]['attributes']: return False
-			if data['products'][k]['attributes']['volumeApiName'] != 'gp2': return False
+			if data['products'][k]['attributes']['volumeApiName'] != 'gp3': return False
 			return True
 
-		pcode = list(filter(gp2, data['products'].keys()))[0]
-		code2 = list(data['terms']['OnDemand'][pcode].keys())[0]
-		code3 = list(data['terms']['OnDemand'][pcode][code2]['priceDimensions'].keys())[0]
-		pricePerUnit = data['terms']['OnDemand'][pcode][code2]['priceDimensions'][code3]['pricePerUnit']['USD']
+		def price(family):
+			pcode = list(filter(lambda k: gp3(k, family), data['products'].keys()))[0]
+			code2 = list(data['terms']['OnDemand'][pcode].keys())[0]
+			code3 = list(data['terms']['OnDemand'][pcode][code2]['priceDimensions'].keys())[0]
+			dim = data['terms']['OnDemand'][pcode][code2]['priceDimensions'][code3]
+			return float(dim['pricePerUnit']['USD']), dim['unit']
+
+		prices = {}
+		prices['ebs_gp3_gb_price'], _ = price('Storage') # GB-Mo
+		prices['ebs_gp3_iops_price'], _ = price('System Operation') # IOPS-Mo
+		mbps_price, unit = price('Provisioned Throughput') # GiBps-mo
+		if unit.lower().startswith('gibps'): mbps_price = mbps_price/1024
+		prices['ebs_gp3_mbps_price'] = mbps_price
 		with self.cache.open() as db:
-			db.execute('insert or replace into meta values(?,?)',('ebs_gp2_price',float(pricePerUnit)))
-		return float(pricePerUnit)
+			for k in keys:
+				db.execute('insert or replace into meta values(?,?)',(k,prices[k]))
+		return prices
+
+	# cheapest set of striped gp3 volumes with the requested size, iops and throughput
+	def find_ebs_volumes(self, storage_gb, iops, mbps, prices):
+		best = None
+		for n in range(1, HD.gp3_max_volumes+1):
+			vol_gb = math.ceil(storage_gb/n)
+			vol_iops = max(HD.gp3_base_iops, math.ceil(iops/n))
+			vol_mbps = max(HD.gp3_base_mbps, math.ceil(mbps/n))
+			vol_iops = max(vol_iops, 4*vol_mbps) # max 0.25 MB/s per iops
+			if vol_iops > HD.gp3_max_iops or vol_mbps > HD.gp3_max_mbps: continue
+			if vol_iops > HD.gp3_base_iops:
+				vol_gb = max(vol_gb, math.ceil(vol_iops/HD.gp3_max_iops_per_gb))
+			if vol_gb > HD.gp3_max_gb: continue
+			month_cost = n*(vol_gb*prices['ebs_gp3_gb_price'] +
+				(vol_iops-HD.gp3_base_iops)*prices['ebs_gp3_iops_price'] +
+				(vol_mbps-HD.gp3_base_mbps)*prices['ebs_gp3_mbps_price'])
+			v = {'ebs_volumes': n, 'ebs_gb': vol_gb, 'ebs_iops': vol_iops, 'ebs_mbps': vol_mbps, 'cost': month_cost/(24*30)}
+			if best is None or v['cost'] < best['cost']: best = v
+		return best
 
 	def create_config(self):
 		cf = boto3.client('cloudformation')
@@ -167,7 +242,10 @@ class HD:
 			sys.exit(1)
 
 		self.conf['cache'] = self.args.cache
-		self.conf['amiId'] = self.args.ami
+		self.conf.pop('amiId', None)
+		self.conf['amiIds'] = {'x86_64': self.args.ami}
+		if self.args.ami_arm64 is not None:
+			self.conf['amiIds']['arm64'] = self.args.ami_arm64
 		self.conf['prefix'] = self.args.prefix
 		self.conf['stackName'] = self.args.stack_name
 		r = cf.describe_stacks(StackName=self.args.stack_name)
@@ -179,25 +257,54 @@ class HD:
 			self.conf[o['OutputKey']] = o['OutputValue']
 		yaml.dump(self.conf, open(self.args.config,'w'))
 
+	def get_ami(self, arch):
+		amis = self.conf.get('amiIds', {})
+		if arch == 'x86_64' and 'amiId' in self.conf: # older configs
+			return amis.get(arch, self.conf['amiId'])
+		return amis.get(arch, None)
+
+	def spawn_subcmd(self, *args):
+		# run a hyperdrive subcommand detached from this process
+		return subprocess.Popen([self.pname, '--config', self.args.config]+list(args),
+			stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+			start_new_session=True)
+
 	def kill_job(self):
-		ec2 = boto3.client('ec2')
 		with self.cache.open() as db:
 			db.execute('update jobs set status=? where jobid=?',('FAILED',self.args.jobid))
 			it, = db.execute('select instance_id from jobs where jobid=?',(self.args.jobid,)).fetchone()
-			ec2.terminate_instances(InstanceIds=[it])
+			if is_local(it):
+				p = local_runner(it)
+				if p is not None:
+					try: os.killpg(p.pid, signal.SIGTERM)
+					except (ProcessLookupError, PermissionError): pass # runner just finished
+			else:
+				boto3.client('ec2').terminate_instances(InstanceIds=[it])
 
 	def clean_cache(self):
 		with self.cache.open() as db:
 			for jobid, st in db.execute('select jobid, status from jobs'):
 				if st in HD.job_end_states:
 					db.execute('delete from jobs where jobid=?',(jobid,))
+			active = set(map(lambda r: r[0], db.execute('select jobid from jobs').fetchall()))
+		# logs and workflow copies left by local jobs
+		local_dir = os.path.dirname(self.local_log_path(''))
+		if not os.path.exists(local_dir): return
+		for f in os.listdir(local_dir):
+			jobid = f[:-len('.log')] if f.endswith('.log') else f
+			if jobid in active: continue
+			f = os.path.join(local_dir, f)
+			if os.path.isdir(f): shutil.rmtree(f, ignore_errors=True)
+			else: os.remove(f)
 
 	def find_instances_req(self, job_info):
 		n_cpus = job_info['cpus']
 		mem_mb = job_info['mem_mb']
+		archs = list(filter(lambda a: self.get_ami(a) is not None, job_info['archs']))
 		with self.cache.open() as db:
-			c = db.execute('select it,storage_gb from instance_types where cpus>=? and mem_mb>=?',(n_cpus, mem_mb))
-			l = dict(c.fetchall())
+			c = db.execute('select * from instance_types where cpus>=? and mem_mb>=?',(n_cpus, mem_mb))
+			l = dict(map(lambda r: (r['it'], dict(r)), c.fetchall()))
+			l = dict(filter(lambda i: i[1]['arch'] in archs, l.items()))
 			c = db.execute('select distinct key from it_features')
 			features = list(map(lambda i:i[0],c.fetchall()))
 			for k in job_info['resources'].keys():
@@ -208,28 +315,117 @@ class HD:
 				l = dict(filter(lambda i: i[0] in l2, l.items()))
 		return l
 
-	def find_lowest_price(self, instance_list, storage_gb):
+	# pick the scratch storage for a job on the instance type 'info'
+	def find_storage(self, info, storage_gb, iops, mbps, prices):
+		no_ebs = {'ebs_volumes': 0, 'ebs_gb': 0, 'ebs_iops': 0, 'ebs_mbps': 0, 'cost': 0}
+		if iops == 0 and mbps == 0:
+			# instance storage + gp3 baseline for the rest
+			extra_gb = max(0, storage_gb - info['storage_gb'])
+			ebs = self.find_ebs_volumes(extra_gb, 0, 0, prices) if extra_gb > 0 else no_ebs
+			if ebs is None: return None
+			return dict(ebs, instance_storage=True)
+		options = []
+		# nvme instance storage is free and fast enough
+		if info['nvme_disks'] > 0 and info['storage_gb'] >= storage_gb:
+			options.append(dict(no_ebs, instance_storage=True))
+		# the instance ebs bandwidth caps the volumes throughput
+		if info['ebs_mbps'] == 0 or info['ebs_mbps'] >= mbps:
+			ebs = self.find_ebs_volumes(max(1,storage_gb), iops, mbps, prices)
+			if ebs is not None: options.append(dict(ebs, instance_storage=False))
+		if len(options) == 0: return None
+		return min(options, key=lambda i:i['cost'])
+
+	def find_lowest_price(self, instance_list, job_info):
 		self.get_spot_prices()
-		ebs_gb_hour = self.get_ebs_gp2_price()/(24*30)
+		prices = self.get_ebs_prices()
 		ls = []
 		with self.cache.open() as db:
 			for i in instance_list.keys():
-				extra_ebs = max(0,storage_gb - instance_list[i])
+				storage = self.find_storage(instance_list[i], job_info['disk_gb'],
+					job_info['disk_iops'], job_info['disk_mbps'], prices)
+				if storage is None: continue
 				for az, ec2_hour in db.execute('select az,price from spot_prices where it=? and backoff<1',(i,)):
-					total_cost = float(ec2_hour) + extra_ebs*ebs_gb_hour
-					ls.append({'az':az,'it':i,'cost':total_cost, 'extra_ebs': extra_ebs, 'instance_storage': instance_list[i]})
-		ls = sorted(ls, key=lambda i:i['cost'])
-		ls2 = list(filter(lambda i: i['cost']<=ls[0]['cost'], ls))
+					total_cost = float(ec2_hour) + storage['cost']
+					ls.append(dict(storage, az=az, it=i, cost=total_cost, arch=instance_list[i]['arch']))
+		objective = self.conf.get('objective', 'price')
+		if objective == 'price':
+			key = lambda i: i['cost']
+		else:
+			runtime_h = self.predict_runtime(job_info['rule'])
+			if runtime_h is None: runtime_h = 1
+			for i in ls:
+				i['runtime_h'] = runtime_h/instance_list[i['it']]['perf']
+				i['job_cost'] = i['cost']*i['runtime_h']
+			if objective == 'cost':
+				key = lambda i: i['job_cost']
+			elif objective == 'makespan':
+				# the cheapest among the fastest, sizes of a family have the same runtime
+				key = lambda i: (i['runtime_h'], i['job_cost'])
+				max_cost = min(map(lambda i:i['job_cost'], ls))*self.conf.get('maxCostRatio', 1.5)
+				ls = list(filter(lambda i: i['job_cost']<=max_cost, ls))
+			else:
+				self.msg('unknown objective: '+objective)
+				sys.exit(1)
+		ls = sorted(ls, key=key)
+		ls2 = list(filter(lambda i: key(i)<=key(ls[0]), ls))
 		return ls2
 
+	# hours the rule takes on a perf=1.0 instance, None if there is no history
+	def predict_runtime(self, rule):
+		with self.cache.open() as db:
+			rs = db.execute('select r.runtime*t.perf from runtimes r join instance_types t on r.it=t.it where r.rule=? order by r.rowid desc limit ?',
+				(rule, HD.runtime_history)).fetchall()
+		if len(rs) == 0: return None
+		rs = sorted(map(lambda i:i[0], rs))
+		return rs[len(rs)//2]/3600
+
+	# seconds the rule took on recent runs anywhere, None if there is no history
+	def rule_runtime(self, rule):
+		with self.cache.open() as db:
+			rs = db.execute('select runtime from runtimes where rule=? order by rowid desc limit ?',
+				(rule, HD.runtime_history)).fetchall()
+		if len(rs) == 0: return None
+		rs = sorted(map(lambda i:i[0], rs))
+		return rs[len(rs)//2]
+
 	def get_instances_info(self):
 		with self.cache.open() as db:
-			n, = db.execute('select count(*) from instance_types').fetchone()
-			if n>0: return
+			r = db.execute('select value from meta where key=?',('catalog_version',)).fetchone()
+		if r is None or r[0] != HD.catalog_version:
+			self.update_instances_info() # missing or outdated, wait for it
+			return
+		# check the age without locking, submit-job runs this many times in parallel
+		ttl = self.conf.get('catalogTtlHours', 7*24)*3600
+		with self.cache.open() as db:
+			r = db.execute('select dt from timed_locks where key=?',('instance_types',)).fetchone()
+		if r is not None and (datetime.datetime.now()-str2dt(r[0])).total_seconds() <= ttl:
+			return
+		if self.cache.timed_lock('instance_types', ttl):
+			self.spawn_subcmd('refresh-catalog')
+
+	def update_instances_info(self):
 		self.msg('getting instance-type data ... ', end='')
 
+		def it_arch(it):
+			for a in ['x86_64','arm64']:
+				if a in it['ProcessorInfo']['SupportedArchitectures']: return a
+			return None
+
+		def it_network_gbps(it):
+			cards = it['NetworkInfo'].get('NetworkCards',[])
+			if len(cards)>0 and 'BaselineBandwidthInGbps' in cards[0]:
+				return sum(map(lambda c: c['BaselineBandwidthInGbps'], cards))
+			# "Up to 10 Gigabit", "25 Gigabit", "Moderate"
+			m = re.search(r'[0-9.]+', it['NetworkInfo']['NetworkPerformance'])
+			return float(m.group(0)) if m is not None else 0
+
+		def it_nvme_disks(it):
+			if 'InstanceStorageInfo' not in it: return 0
+			if it['InstanceStorageInfo'].get('NvmeSupport','unsupported') == 'unsupported': return 0
+			return sum(map(lambda d: d['Count'], it['InstanceStorageInfo']['Disks']))
+
 		def it_filter(it):
-			if 'x86_64' not in it['ProcessorInfo']['SupportedArchitectures']: return False
+			if it_arch(it) is None: return False
 			if 'SustainedClockSpeedInGhz' not in it['ProcessorInfo']: return False
 			if 'spot' not in it['SupportedUsageClasses']: return False
 			if 'ebs' not in it['SupportedRootDeviceTypes']: return False
@@ -242,12 +438,19 @@ class HD:
 
 		features_file = os.path.join(sys.path[0], 'share', 'it_features.json')
 		features = json.load(open(features_file))
+		perf_file = os.path.join(sys.path[0], 'share', 'it_perf.json')
+		perf = json.load(open(perf_file))
 
 		ec2 = boto3.client('ec2')
 		its = boto3_all_results(ec2.describe_instance_types, 'InstanceTypes')
 
 		its = list(filter(it_filter, its))
 		with self.cache.open() as db:
+			# replace the whole catalog at once, readers see either the old or the new one
+			db.execute('BEGIN EXCLUSIVE')
+			db.execute('drop table if exists instance_types')
+			db.execute('drop table if exists it_features')
+			self.cache.create_catalog(db)
 			for i in its:
 				k = i['InstanceType']
 				storage_gb = 0
@@ -255,8 +458,17 @@ class HD:
 					for f in features[k].keys():
 						db.execute('insert into it_features values(?,?,?)',(k,f,features[k][f]))
 				if 'InstanceStorageInfo' in i: storage_gb = i['InstanceStorageInfo']['TotalSizeInGB']
-				db.execute('insert into instance_types (it,cpus,mem_mb,storage_gb) values(?,?,?,?)',
-				(k, i['VCpuInfo']['DefaultVCpus'], i['MemoryInfo']['SizeInMiB'], storage_gb))
+				ebs_mbps = i.get('EbsInfo',{}).get('EbsOptimizedInfo',{}).get('BaselineThroughputInMBps',0)
+				clock_ghz = i['ProcessorInfo']['SustainedClockSpeedInGhz']
+				it_perf = perf.get(k.split('.')[0], clock_ghz/HD.perf_ref_ghz)
+				db.execute('insert into instance_types (it,cpus,mem_mb,storage_gb,arch,network_gbps,ebs_mbps,nvme_disks,clock_ghz,perf) values(?,?,?,?,?,?,?,?,?,?)',
+				(k, i['VCpuInfo']['DefaultVCpus'], i['MemoryInfo']['SizeInMiB'], storage_gb,
+				it_arch(i), it_network_gbps(i), ebs_mbps, it_nvme_disks(i), clock_ghz, it_perf))
+			db.execute('insert or replace into meta values(?,?)',('catalog_version',HD.catalog_version))
+			db.execute('insert or replace into timed_locks values(?,?)',('instance_types',datetime.datetime.now()))
+			# fetch prices for the new types on the next call
+			db.execute('delete from timed_locks where key=?',('spot_prices',))
+			db.execute('END')
 		self.msg('done', head=False)
 
 	def get_spot_prices(self):
@@ -291,7 +503,15 @@ class HD:
 					(it,az, float(prices[it][az]['price']),0))
 		self.msg('done', head=False)
 
-	def host_userscript(self, jobid, job_info):
+	def host_userscript(self, jobid, job_info, instance):
+		script = self.render_userscript(jobid, job_info, instance)
+		if len(script) > HD.userdata_max_bytes:
+			# the log list is the only part that grows with the job, stream only the main log
+			self.msg('userdata too large, not streaming the rule log files')
+			script = self.render_userscript(jobid, dict(job_info, log=[]), instance)
+		return script
+
+	def render_userscript(self, jobid, job_info, instance):
 		host_file = os.path.join(sys.path[0], 'share', 'host.py')
 		if not os.path.exists(host_file):
 			self.msg('cant find host script: {}'.format(host_file))
@@ -302,11 +522,37 @@ class HD:
 			'sqs_url':self.conf['jobQueueUrl'],
 			'prefix':self.conf['prefix'],
 			'log_group':self.conf['logGroupName'],
-			'extra_logs': job_info['log']
+			'extra_logs': job_info['log'],
+			'rule': job_info['rule'],
+			'storage': {
+				'instance_storage': instance['instance_storage'],
+				'ebs_volumes': instance['ebs_volumes']
+			}
 		}))
 		return script
 
 	def print_log(self):
+		with self.cache.open() as db:
+			r = db.execute('select instance_id from jobs where jobid=?',(self.args.jobid,)).fetchone()
+		if r is not None and is_local(r[0]):
+			self.print_local_log()
+		else:
+			self.print_cloudwatch_log()
+		print('------')
+		with self.cache.open() as db:
+			r = db.execute('select status from jobs where jobid=?',(self.args.jobid,)).fetchone()
+			if r is not None: print('status: '+r[0])
+
+	def print_local_log(self):
+		log_file = self.local_log_path(self.args.jobid)
+		if not os.path.exists(log_file):
+			self.msg('no log data')
+			sys.exit(1)
+		lines = open(log_file).readlines()
+		lines = lines[:self.args.lines] if self.args.head else lines[-self.args.lines:]
+		for l in lines: print(l,end='')
+
+	def print_cloudwatch_log(self):
 		logs = boto3.client('logs')
 		try:
 			r = logs.get_log_events(
@@ -327,10 +573,6 @@ class HD:
 			if prev_ln: print(d,'|',l['message'],end='')
 			else: print(l['message'],end='')
 			prev_ln = l['message'].endswith('\n')
-		print('------')
-		with self.cache.open() as db:
-			r = db.execute('select status from jobs where jobid=?',(self.args.jobid,)).fetchone()
-			if r is not None: print('status: '+r[0])
 
 	def print_status(self):
 		# only refresh if delta time > 30 seconds
@@ -361,9 +603,14 @@ class HD:
 				j = json.loads(m['Body'])
 				r = db.execute('select status from jobs where jobid=?',(j['jobid'],)).fetchone()
 				if r is not None:
-					db.execute('update jobs set status=? where jobid=?',(j['status'],j['jobid']))
 					sqs.delete_message(QueueUrl=self.conf['jobQueueUrl'],
 						ReceiptHandle=m['ReceiptHandle'])
+					if j['status'] == 'INTERRUPTED':
+						self.job_interrupted(j)
+						continue
+					db.execute('update jobs set status=? where jobid=?',(j['status'],j['jobid']))
+					if j['status'] == 'SUCCESS' and j.get('rule','') != '':
+						db.execute('insert into runtimes (rule,it,runtime) values(?,?,?)',(j['rule'],j['instance_type'],j['runtime']))
 					if j['status'] in HD.job_end_states:
 						now = datetime.datetime.now().replace(microsecond=0)
 						db.execute('update jobs set end_time=? where jobid=?',(now,j['jobid']))
@@ -372,16 +619,40 @@ class HD:
 		with self.cache.open() as db:
 			db.execute('update spot_prices set backoff = backoff + 1 where it=? and az=?',(instance_type,az))
 
+	def relaunch_job(self, jobid, instance_type, az):
+		with self.cache.open() as db:
+			db.execute('update jobs set status = ? where jobid=?',('PENDING',jobid))
+			jobscript, = db.execute('select orig_jobscript from jobs where jobid=?',(jobid,)).fetchone()
+		self.increase_it_backoff(instance_type, az)
+		self.req_instance(jobid, jobscript) # retry job
+
+	# spot interruption notice sent by the instance
+	def job_interrupted(self, j):
+		with self.cache.open() as db:
+			r = db.execute('select status, instance_id from jobs where jobid=?',(j['jobid'],)).fetchone()
+		# ignore if the job was already relaunched or killed
+		if r['status'] != 'RUNNING' or r['instance_id'] != j['instance_id']: return
+		self.msg('{} interrupted on {} {}, relaunching'.format(j['jobid'],j['instance_type'],j['az']))
+		self.relaunch_job(j['jobid'], j['instance_type'], j['az'])
+
 	def check_instance_status(self, delta_seconds=7):
 		if not self.cache.timed_lock('instance_status', delta_seconds):
 			return
 
 		instance_ids = {}
+		local_jobs = {}
 		with self.cache.open() as db:
 			for jobid, st, instance_id in db.execute('select jobid,status,instance_id from jobs'):
+				if st in HD.job_end_states: continue
+				if is_local(instance_id):
+					local_jobs[instance_id] = jobid
+					continue
 				if st != 'RUNNING': continue
 				instance_ids[instance_id] = jobid
 
+		for instance_id, jobid in local_jobs.items():
+			self.check_local_job(jobid, instance_id)
+
 		if len(instance_ids)==0: return
 
 		ec2 = boto3.client('ec2')
@@ -406,20 +677,139 @@ class HD:
 					if src == 'Client.InstanceInitiatedShutdown':
 						pass # job finished, wait for sqs msg
 					elif src in backoff_states: # backoff & retry
-						set_job_status(jobid, 'PENDING')
-						self.increase_it_backoff(it, az)
-						with self.cache.open() as db:
-							jobscript, = db.execute('select orig_jobscript from jobs where jobid=?',(jobid,)).fetchone()
-						self.req_instance(jobid, jobscript) # retry job
+						self.relaunch_job(jobid, it, az)
 					elif src == 'Client.UserInitiatedShutdown':
 						set_job_status(jobid, 'FAILED') # terminated by ec2 api
 					else: # ???
 						set_job_status(jobid, 'FAILED')
 						raise Exception(j)
 
+	# the local runner updates the job itself, only catch runners that died
+	def check_local_job(self, jobid, instance_id):
+		if local_runner(instance_id) is None:
+			with self.cache.open() as db:
+				db.execute('update jobs set status=? where jobid=? and status not in (?,?)',('FAILED',jobid)+tuple(HD.job_end_states))
+
+	def local_log_path(self, jobid):
+		return os.path.join('.snakemake', 'hyperdrive', jobid+'.log')
+
+	def local_job_dir(self, jobid):
+		return os.path.join('.snakemake', 'hyperdrive', jobid)
+
+	def local_lane_conf(self):
+		return self.conf.get('localLane') or {}
+
+	# copy of the workflow for a local job, like the one an instance gets
+	def setup_local_job_dir(self, jobid, jobscript):
+		job_dir = os.path.abspath(self.local_job_dir(jobid))
+		bucket, _ = s3_split_path(self.conf['prefix'])
+		skip = ['.snakemake', '.git', self.args.config, self.conf['cache'], bucket]
+		def ignore(d, names):
+			if os.path.abspath(d) != os.getcwd(): return []
+			return list(filter(lambda n: n in skip, names))
+		shutil.copytree('.', job_dir, ignore=ignore, symlinks=True)
+		# share the conda envs and singularity images with the main workflow
+		os.makedirs(os.path.join(job_dir, '.snakemake'))
+		for d in ['conda', 'singularity']:
+			shared = os.path.abspath(os.path.join('.snakemake', d))
+			os.makedirs(shared, exist_ok=True)
+			os.symlink(shared, os.path.join(job_dir, '.snakemake', d))
+		script = open(jobscript).read()
+		script = script.replace('cd {} &&'.format(os.getcwd()), 'cd {} &&'.format(job_dir))
+		job_script = os.path.join(job_dir, '.hyperdrive-job.sh')
+		with open(job_script, 'w') as f: f.write(script)
+		return job_dir, job_script
+
+	# tiny jobs run on this machine instead of waiting for an instance
+	def use_local_lane(self, job_info):
+		if 'localLane' not in self.conf: return False
+		lane = self.local_lane_conf()
+		if job_info['rule'] in lane.get('rules', []): return True
+		if job_info['cpus'] > lane.get('maxCpus', 1): return False
+		if job_info['mem_mb'] > lane.get('maxMemMb', 1000): return False
+		if job_info['disk_gb'] > 0 or job_info['disk_iops'] > 0 or job_info['disk_mbps'] > 0: return False
+		# only rules known to be short
+		runtime = self.rule_runtime(job_info['rule'])
+		if runtime is None or runtime > lane.get('maxRuntime', 60): return False
+		return True
+
+	# start a runner if the lane has room, returns False if it is full
+	def submit_local_job(self, jobid, jobscript, job_info):
+		lane = self.local_lane_conf()
+		max_local = lane.get('maxJobs', 2) + lane.get('maxQueued', 0)
+		now = datetime.datetime.now().replace(microsecond=0)
+		with self.cache.open() as db:
+			db.execute('BEGIN EXCLUSIVE')
+			n = 0
+			for st, instance_id in db.execute('select status,instance_id from jobs').fetchall():
+				if st not in HD.job_end_states and is_local(instance_id): n += 1
+			if n >= max_local:
+				db.execute('END')
+				return False
+			p = self.spawn_subcmd('run-local', jobid)
+			db.execute('insert or replace into jobs (jobid,jobname,status,start_time,instance_id,orig_jobscript) values(?,?,?,?,?,?)',
+			(jobid, job_info['jobname'], 'PENDING', now, local_instance_id(p.pid), jobscript))
+			db.execute('END')
+		return True
+
+	# wait for a free slot on the local lane, returns False if the job was killed meanwhile
+	def claim_local_slot(self, jobid):
+		max_jobs = self.local_lane_conf().get('maxJobs', 2)
+		while True:
+			with self.cache.open() as db:
+				db.execute('BEGIN EXCLUSIVE')
+				r = db.execute('select status from jobs where jobid=?',(jobid,)).fetchone()
+				if r is None or r[0] != 'PENDING':
+					db.execute('END')
+					return False
+				n = 0
+				for st, instance_id in db.execute('select status,instance_id from jobs'):
+					if st == 'RUNNING' and is_local(instance_id): n += 1
+				if n < max_jobs:
+					db.execute('update jobs set status=? where jobid=?',('RUNNING',jobid))
+					db.execute('END')
+					return True
+				db.execute('END')
+			time.sleep(5)
+
+	def run_local_job(self):
+		jobid = self.args.jobid
+		# on kill, stop the job and still clean up
+		def stop(signum, frame): raise SystemExit(1)
+		signal.signal(signal.SIGTERM, stop)
+		# give the submitting process time to register the job
+		for i in range(10):
+			if self.get_job_status(jobid) is not None: break
+			time.sleep(1)
+		if not self.claim_local_slot(jobid): return
+		with self.cache.open() as db:
+			jobscript, = db.execute('select orig_jobscript from jobs where jobid=?',(jobid,)).fetchone()
+		job_info = self.get_job_info(jobscript)
+		log_file = self.local_log_path(jobid)
+		os.makedirs(os.path.dirname(log_file), exist_ok=True)
+		# lower priority, dont starve snakemake and the other hyperdrive calls
+		os.nice(self.local_lane_conf().get('nice', 10))
+		t0 = datetime.datetime.now()
+		try:
+			with open(log_file, 'w') as log:
+				# each job gets its own directory, remote files downloaded (and deleted)
+				# by one job dont clash with the other jobs
+				job_dir, job_script = self.setup_local_job_dir(jobid, jobscript)
+				p = subprocess.run(['bash', job_script], cwd=job_dir,
+					stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+		finally:
+			shutil.rmtree(os.path.abspath(self.local_job_dir(jobid)), ignore_errors=True)
+		runtime = (datetime.datetime.now()-t0).total_seconds()
+		status = 'SUCCESS' if p.returncode == 0 else 'FAILED'
+		now = datetime.datetime.now().replace(microsecond=0)
+		with self.cache.open() as db:
+			db.execute('update jobs set status=?, end_time=? where jobid=?',(status,now,jobid))
+			if status == 'SUCCESS' and job_info['rule'] != '':
+				db.execute('insert into runtimes (rule,it,runtime) values(?,?,?)',(job_info['rule'],'local',runtime))
+
 	def get_job_status(self, jobid):
 		with self.cache.open() as db:
-			r = db.execute('select status from jobs where jobid=?', (self.args.jobid,)).fetchone()
+			r = db.execute('select status from jobs where jobid=?', (jobid,)).fetchone()
 			if r is None: return None
 			return r[0]
 
@@ -441,25 +831,37 @@ class HD:
 		job_properties = read_job_properties(jobpath)
 		mem_mb = 500
 		disk_gb = 0
+		disk_iops = 0
+		disk_mbps = 0
 		if 'resources' in job_properties:
 			if 'mem_mb' in job_properties['resources']: mem_mb = job_properties['resources']['mem_mb']
 			elif 'mem_gb' in job_properties['resources']: mem_mb = 1024*job_properties['resources']['mem_gb']
 			if 'disk_gb' in job_properties['resources']: disk_gb = job_properties['resources']['disk_gb']
 			elif 'disk_mb' in job_properties['resources']: disk_gb = math.ceil(job_properties['resources']['disk_mb']/1024)
+			disk_iops = job_properties['resources'].get('disk_iops', 0)
+			disk_mbps = job_properties['resources'].get('disk_mbps', 0)
 		jobname = "hd-{}-{}".format(job_properties['rule'], job_properties['jobid'])
 		return {
 			'jobname': jobname,
 			'mem_mb': mem_mb,
 			'disk_gb': disk_gb,
+			'disk_iops': disk_iops,
+			'disk_mbps': disk_mbps,
 			'cpus': job_properties.get('threads',1),
 			'resources': job_properties.get('resources',{}),
 			'log': job_properties.get('log',[]),
 			'rule': job_properties.get('rule',''),
+			'archs': ['x86_64','arm64'] if job_properties.get('resources',{}).get('arm64',0) else ['x86_64'],
 			'wildcards': job_properties.get('wildcards',{}),
 		}
 
 	def submit_job(self):
 		jobid = str(uuid.uuid4())
+		job_info = self.get_job_info(self.args.jobscript)
+		if self.use_local_lane(job_info) and self.submit_local_job(jobid, self.args.jobscript, job_info):
+			print(jobid)
+			return
+		self.get_instances_info()
 		s3 = boto3.client('s3')
 		bucket, pkey = s3_split_path(self.conf['prefix'])
 		s3.upload_file(self.args.jobscript, bucket, os.path.join(pkey,'_jobs',jobid))
@@ -470,10 +872,10 @@ class HD:
 		ec2 = boto3.client('ec2')
 		job_info = self.get_job_info(jobscript)
 		its = self.find_instances_req(job_info)
-		its = self.find_lowest_price(its, job_info['disk_gb'])
+		its = self.find_lowest_price(its, job_info)
 		instance = random.choice(its)
 		sys.stderr.write(str(instance)+'\n')
-		userdata = self.host_userscript(jobid, job_info)
+		userdata = self.host_userscript(jobid, job_info, instance)
 		tags = [
 			{'Key': 'Name', 'Value': job_info['jobname'] },
 			{'Key': 'hyperdrive.prefix', 'Value': self.conf['prefix'] },
@@ -484,16 +886,21 @@ class HD:
 		for k in job_info['wildcards'].keys():
 			tags.append({ 'Key': 'hyperdrive.wildcards.'+k, 'Value': job_info['wildcards'][k] })
 		block_devices = []
-		if instance['extra_ebs'] > 0:
+		for k in range(instance['ebs_volumes']):
 			block_devices.append({
-				'DeviceName': '/dev/xvdz',
-				'Ebs': { 'VolumeSize': instance['extra_ebs'], 'VolumeType': 'gp2' }
+				'DeviceName': '/dev/xvd'+chr(ord('z')-k), # xvdz, xvdy, ...
+				'Ebs': {
+					'VolumeSize': instance['ebs_gb'],
+					'VolumeType': 'gp3',
+					'Iops': instance['ebs_iops'],
+					'Throughput': instance['ebs_mbps']
+				}
 			})
 		try:
 			r = ec2.run_instances(
 				MinCount=1, MaxCount=1,
 				SecurityGroupIds=[self.conf['securityGroupId']],
-				ImageId=self.conf['amiId'],
+				ImageId=self.get_ami(instance['arch']),
 				InstanceType=instance['it'],
 				Placement={ 'AvailabilityZone': instance['az'] },
 				UserData=userdata,
@@ -541,7 +948,7 @@ class HD:
 				])
 				if p.returncode != 0: sys.exit(p.returncode)
 				self.get_instances_info()
-				self.get_ebs_gp2_price()
+				self.get_ebs_prices()
 				self.get_spot_prices()
 			os.execvp('snakemake',['snakemake',
 				'--default-remote-provider', 'S3',
@@ -569,9 +976,15 @@ class HD:
 		elif self.args.subcmd == 'clean-cache':
 			self.clean_cache()
 
+		elif self.args.subcmd == 'refresh-catalog':
+			self.update_instances_info()
+
 		elif self.args.subcmd == 'kill':
 			self.kill_job()
 
+		elif self.args.subcmd == 'run-local':
+			self.run_local_job()
+
 		elif self.args.subcmd == 'log':
 			self.print_log()
 
@@ -2,6 +2,11 @@
 set -e
 cd /root
 
+# x86_64 or aarch64
+ARCH=$(uname -m)
+GOARCH=amd64
+if [ "$ARCH" = "aarch64" ]; then GOARCH=arm64; fi
+
 # locale
 echo -e "export LC_ALL=C\nexport LANG=C" > /etc/profile.d/lang.sh
 source /etc/profile.d/lang.sh
@@ -14,7 +19,7 @@ mv /home/ec2-user /tmp
 yum -y remove postfix mariadb-libs selinux-policy cronie audit update-motd amazon-linux-extras gdisk libicu man-db less glibc-locale-source glibc-all-langpacks
 
 # install conda
-curl https://repo.anaconda.com/miniconda/Miniconda3-latest-Linux-x86_64.sh -o conda.sh
+curl https://repo.anaconda.com/miniconda/Miniconda3-latest-Linux-$ARCH.sh -o conda.sh
 bash conda.sh -bfp /opt/conda
 rm -f conda.sh
 ln -s /opt/conda/etc/profile.d/conda.sh /etc/profile.d/conda.sh
@@ -28,14 +33,31 @@ conda clean --all --yes
 yum -y install git gcc libuuid-devel openssl-devel libseccomp-devel squashfs-tools cryptsetup glibc-minimal-langpack mdadm
 yum -y update
 
+# build dir on instance storage, cloud-init only mounts it on xen instances
+BUILD_DIR=/media/ephemeral0
+if ! mountpoint -q $BUILD_DIR; then
+	for d in $(lsblk -d -n -p -o NAME,TYPE | awk '$2=="disk" {print $1}'); do
+		if [ -z "$(lsblk -n -o MOUNTPOINT $d | tr -d '[:space:]')" ]; then
+			mkfs.xfs -f $d
+			mkdir -p $BUILD_DIR
+			mount $d $BUILD_DIR
+			break
+		fi
+	done
+fi
+if ! mountpoint -q $BUILD_DIR; then
+	echo "no instance storage for the build, use an instance type with instance storage"
+	exit 1
+fi
+
 # install singularity
-curl https://dl.google.com/go/go1.13.6.linux-amd64.tar.gz -o go.tar.gz
+curl https://dl.google.com/go/go1.13.6.linux-$GOARCH.tar.gz -o go.tar.gz
 tar xf go.tar.gz
 rm -f go.tar.gz
-export GOCACHE=/media/ephemeral0/tmp
+export GOCACHE=$BUILD_DIR/tmp
 export HOME=/root
 export VERSION=v3.5.2
-export GOPATH=/media/ephemeral0/gopath
+export GOPATH=$BUILD_DIR/gopath
 export PATH=/root/go/bin:$PATH
 go get -d github.com/sylabs/singularity || true
 cd $GOPATH/src/github.com/sylabs/singularity
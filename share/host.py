@@ -1,8 +1,10 @@
 #!/opt/conda/bin/python3
 import boto3
+import botocore
 import pwd
 import os
 import requests
+import re
 import subprocess
 import functools
 import json
@@ -11,6 +13,9 @@ import time
 import psutil
 import inotify_simple
 import multiprocessing
+import threading
+import concurrent.futures
+from boto3.s3.transfer import TransferConfig
 # always flush to keep the log going
 print = functools.partial(print, flush=True)
 
@@ -21,8 +26,14 @@ workflow_path = os.path.join(basedir, 'workflow')
 jobscript_path = os.path.join(basedir, 'job.sh')
 log_path = '/var/log/cloud-init-output.log'
 aws = os.path.join(conda_bin_path,'aws')
+# prefetch: files downloaded at once, ranged GETs per file
+prefetch_files = 4
+prefetch_parts = 16
+prefetch_part_size = 64*2**20
 
 data = json.loads('''<DATA>''')
+interrupted = threading.Event()
+job_procs = []
 
 def get_metadata():
 	r = requests.get('http://169.254.169.254/latest/dynamic/instance-identity/document')
@@ -33,7 +44,7 @@ region = metadata['region']
 sqs = boto3.client('sqs', region_name=region)
 
 def lsblk():
-	p=subprocess.run(['lsblk','-b','-r','-p'],stdout=subprocess.PIPE)
+	p=subprocess.run(['lsblk','-b','-r','-p','-o','NAME,SIZE,TYPE,MOUNTPOINT,MODEL'],stdout=subprocess.PIPE)
 	lines = p.stdout.decode().rstrip().split('\n')
 	header = lines[0].split(' ')
 	h = []
@@ -76,9 +87,18 @@ def log_watcher():
 				kvargs['sequenceToken'] = r['nextSequenceToken']
 
 def setup_storage():
+	storage = data.get('storage', {'instance_storage': True, 'ebs_volumes': 0})
+	# scratch volumes are mapped at xvdz, xvdy, ...
+	ebs_names = list(map(lambda k: '/dev/xvd'+chr(ord('z')-k), range(storage['ebs_volumes'])))
+	def is_ebs(d):
+		# nvme devices (nitro) report the model, xen devices keep the mapped name
+		return 'Elastic\\x20Block\\x20Store' in d['MODEL'] or d['NAME'] in ebs_names
+
 	h = lsblk()
 	root = list(filter(lambda i:i['MOUNTPOINT']=='/', h))[0]
 	disks = list(filter(lambda i:i['TYPE']=='disk' and i['NAME'] not in root['NAME'], h))
+	if not storage['instance_storage']:
+		disks = list(filter(is_ebs, disks))
 	to_umount = list(filter(lambda i:i['MOUNTPOINT']!='/' and i['MOUNTPOINT'] != '', h))
 	# 1. umount ephemeral
 	for i in to_umount:
@@ -103,6 +123,80 @@ def setup_storage():
 	subprocess.run(['mv','/home/ec2-user',mountdir])
 	subprocess.run(['chmod','777',mountdir])
 
+# inputs declared on the '# properties = {...}' line of the jobscript
+def job_inputs():
+	try:
+		for l in open(jobscript_path):
+			m = re.match(r'^# properties = (.*)', l)
+			if m is not None: return json.loads(m.group(1)).get('input',[])
+	except Exception as e:
+		print('hyperdrive: cant read the jobscript properties, no prefetch: {}'.format(e))
+	return []
+
+# download the job inputs to the path the S3 remote provider expects,
+# snakemake will skip the download of files that are already up-to-date
+def prefetch_inputs(inputs):
+	cfg = botocore.config.Config(max_pool_connections=prefetch_files*prefetch_parts)
+	s3 = boto3.client('s3', region_name=region, config=cfg)
+	tc = TransferConfig(multipart_threshold=prefetch_part_size, multipart_chunksize=prefetch_part_size, max_concurrency=prefetch_parts)
+	def fetch(path):
+		if '/' not in path: return 0
+		bucket, key = path.split('/',1)
+		dest = os.path.join(workflow_path, path)
+		try:
+			r = s3.head_object(Bucket=bucket, Key=key)
+			os.makedirs(os.path.dirname(dest), exist_ok=True)
+			s3.download_file(bucket, key, dest, Config=tc)
+			# match the remote mtime so snakemake sees the local copy as current
+			mtime = r['LastModified'].timestamp()
+			os.utime(dest, (mtime, mtime))
+			return r['ContentLength']
+		except Exception as e:
+			print('hyperdrive: prefetch failed for {}: {}'.format(path, e))
+			if os.path.exists(dest): os.remove(dest)
+			return 0
+
+	inputs = sorted(set(inputs))
+	if len(inputs)==0: return
+	t0 = datetime.datetime.now()
+	with concurrent.futures.ThreadPoolExecutor(max_workers=prefetch_files) as pool:
+		n_bytes = sum(pool.map(fetch, inputs))
+	dt = max((datetime.datetime.now()-t0).total_seconds(), 1e-3)
+	print('prefetch: {} files, {:.1f}GB in {:.1f}s, {:.1f}MB/s'.format(len(inputs),n_bytes/2**30,dt,n_bytes/2**20/dt))
+
+# kill the job and everything it started
+def stop_job(p):
+	try:
+		procs = psutil.Process(p.pid).children(recursive=True)
+	except psutil.NoSuchProcess:
+		return
+	for c in procs+[p]:
+		try: c.terminate()
+		except psutil.NoSuchProcess: pass
+
+# the spot interruption notice comes 2 minutes before the instance is reclaimed,
+# tell the client right away so the job can be relaunched elsewhere
+def interruption_watcher():
+	url = 'http://169.254.169.254/latest/meta-data/spot/instance-action'
+	while True:
+		try:
+			r = requests.get(url, timeout=2)
+		except requests.exceptions.RequestException:
+			r = None
+		if r is not None and r.status_code == 200:
+			break
+		time.sleep(5)
+	interrupted.set()
+	print('hyperdrive: spot interruption notice: '+r.text)
+	sqs.send_message(QueueUrl=data['sqs_url'], MessageBody=json.dumps({
+		'jobid':data['jobid'],
+		'status':'INTERRUPTED',
+		'instance_id':metadata['instanceId'],
+		'instance_type':metadata['instanceType'],
+		'az':metadata['availabilityZone']
+	}))
+	for p in job_procs: stop_job(p)
+
 # collect peak metrics while 'p' is running
 def gather_metrics(p):
 	m = psutil.virtual_memory()
@@ -134,12 +228,17 @@ def run():
 	t0 = datetime.datetime.now()
 	# setup logging
 	multiprocessing.Process(target=log_watcher).start()
+	threading.Thread(target=interruption_watcher, daemon=True).start()
 	# setup storage
 	setup_storage()
 	# copy jobscript to /root
 	subprocess.run([aws,'s3','cp',os.path.join('s3://',data['prefix'],'_jobs',data['jobid']),jobscript_path])
+	# download inputs while the rest of the bootstrap runs
+	prefetch = threading.Thread(target=prefetch_inputs, args=(job_inputs(),))
+	prefetch.start()
 	# sync workflow
 	subprocess.run([aws,'s3','sync','--no-progress',os.path.join('s3://',data['prefix'],'_workflow'),workflow_path])
+	prefetch.join()
 	# set permissions on workflow
 	pwr = pwd.getpwnam('ec2-user')
 	subprocess.run(['chown','-R',"{}:{}".format(pwr.pw_uid,pwr.pw_gid),basedir])
@@ -149,18 +248,31 @@ def run():
 	job_env['LANG'] = 'C'
 	job_env['HOME'] = basedir
 	job_env['PATH'] = conda_bin_path + os.pathsep + job_env['PATH']
+	if interrupted.is_set(): return
 	print('--JOB-START--')
+	t1 = datetime.datetime.now()
 	p=subprocess.Popen(['bash',jobscript_path], preexec_fn=functools.partial(drop_priv, pwr), env=job_env, cwd=workflow_path)
+	job_procs.append(p)
+	if interrupted.is_set(): stop_job(p)
 	m = gather_metrics(p)
-	print('--JOB-END--')
+	job_runtime = (datetime.datetime.now()-t1).total_seconds()
+	print('--JOB-END--' if not interrupted.is_set() else '--JOB-INTERRUPTED--')
 	print('peak memory: {:.1f}MB, {:.1f}GB, {:.1f}% of {:.1f}GB'.format(m['max_mem_mb'],m['max_mem_mb']/1024,100*m['max_mem_mb']/m['tot_mem_mb'],m['tot_mem_mb']/1024))
 	print('peak disk: {:.1f}MB, {:.1f}GB, {:.1f}% of {:.1f}GB'.format(m['max_disk_mb'],m['max_disk_mb']/1024,100*m['max_disk_mb']/m['tot_disk_mb'],m['tot_disk_mb']/1024))
 	print('peak cpu: {:.1f}% / {} cores'.format(m['max_cpu_usage'],m['n_cores']))
 	print('avg cpu: {:.1f}% / {} cores'.format(m['tot_cpu_usage']/m['n_samples'],m['n_cores']))
 	print('total runtime: {}'.format(datetime.datetime.now()-t0))
 
-	if p.returncode == 0:
-		sqs.send_message(QueueUrl=data['sqs_url'], MessageBody=json.dumps({'jobid':data['jobid'],'status':'SUCCESS'}))
+	if interrupted.is_set():
+		pass # client already notified, the job will run somewhere else
+	elif p.returncode == 0:
+		sqs.send_message(QueueUrl=data['sqs_url'], MessageBody=json.dumps({
+			'jobid':data['jobid'],
+			'status':'SUCCESS',
+			'rule':data['rule'],
+			'instance_type':metadata['instanceType'],
+			'runtime':job_runtime
+		}))
 	else:
 		sqs.send_message(QueueUrl=data['sqs_url'], MessageBody=json.dumps({'jobid':data['jobid'],'status':'FAILED'}))
 
@@ -169,7 +281,7 @@ if __name__ == '__main__':
 		run()
 	except Exception as e:
 		print(e)
-		sqs.send_message(QueueUrl=data['sqs_url'], MessageBody=json.dumps({'jobid':data['jobid'],'status':'FAILED'}))
+		if not interrupted.is_set(): sqs.send_message(QueueUrl=data['sqs_url'], MessageBody=json.dumps({'jobid':data['jobid'],'status':'FAILED'}))
 	time.sleep(3) # give some time for the logging to finish
 	subprocess.run(['sudo','poweroff'])
 